@@ -5,9 +5,35 @@ One class, one job: detect when user starts speaking during TTS playback
 """
 
 import numpy as np
-from typing import Optional
-from scipy.fft import rfft
-from collections import deque
+from bisect import bisect_left, insort
+
+
+_MULAW_TABLE = None
+_RFFT = None
+
+
+def _get_mulaw_table() -> np.ndarray:
+    """Mu-law decode table, built once and shared (read-only) by all hooks"""
+    global _MULAW_TABLE
+    if _MULAW_TABLE is None:
+        ulaw = ~np.arange(256, dtype=np.int32) & 0xFF
+        sign = np.where(ulaw & 0x80, -1, 1)
+        magnitude = ((ulaw & 0x0F) << 3) + 0x84
+        magnitude <<= (ulaw & 0x70) >> 4
+        pcm16 = sign * (magnitude - 0x84)
+        table = (pcm16 / 32768.0).astype(np.float32)
+        table.setflags(write=False)
+        _MULAW_TABLE = table
+    return _MULAW_TABLE
+
+
+def _get_rfft():
+    """scipy.fft.rfft, imported on first use (small frames never need it)"""
+    global _RFFT
+    if _RFFT is None:
+        from scipy.fft import rfft
+        _RFFT = rfft
+    return _RFFT
 
 
 class SpeechHook:
@@ -29,147 +55,271 @@ class SpeechHook:
         # State
         self.is_speaking = False
         self.consecutive_speech = 0
-        self.noise_history = deque(maxlen=50)  # 1 second of history
-        self.prev_spectrum = None
-        self.last_sample = 0.0
+        self._noise_ring = np.zeros(50, dtype=np.float64)  # 1 second of history
+        self._noise_head = 0  # Next slot to overwrite
+        self._noise_fill = 0  # Number of valid entries
+        self._noise_sorted = []  # Same scores kept sorted for O(1) median
+        self.last_sample = 0.0  # Pre-emphasis input carried across calls
         
         # Mu-law decode table (precomputed for speed)
-        self._mulaw_table = self._build_mulaw_table()
+        self._mulaw_table = _get_mulaw_table()
+    
+    @property
+    def sample_rate(self) -> int:
+        return self._sample_rate
+    
+    @sample_rate.setter
+    def sample_rate(self, sample_rate: int):
+        self._sample_rate = sample_rate
+        # Per-frame tables depend on the rate too; rebuild them if already set up
+        if hasattr(self, '_frame_size'):
+            self.frame_size = self._frame_size
+    
+    @property
+    def frame_size(self) -> int:
+        return self._frame_size
     
-    def _build_mulaw_table(self) -> np.ndarray:
-        """Precompute mu-law decode table"""
-        table = np.zeros(256, dtype=np.float32)
-        for i in range(256):
-            ulaw = (~i) & 0xFF
-            sign = -1 if (ulaw & 0x80) else 1
-            magnitude = ((ulaw & 0x0F) << 3) + 0x84
-            magnitude <<= (ulaw & 0x70) >> 4
-            pcm16 = sign * (magnitude - 0x84)
-            table[i] = pcm16 / 32768.0
-        return table
+    @frame_size.setter
+    def frame_size(self, frame_size: int):
+        self._frame_size = frame_size
+        # Hann window (precomputed, rebuilt if frame size is tuned)
+        self._window = np.hanning(frame_size).astype(np.float32)
+        # Speech band (300-3400 Hz) as a contiguous range of rfft bins,
+        # clamped for sample rates whose Nyquist falls inside the band
+        nbins = frame_size // 2 + 1
+        speech_lo = int(-(-300 * frame_size // self.sample_rate))
+        speech_hi = int(3400 * frame_size // self.sample_rate + 1)
+        speech_band = slice(min(speech_lo, nbins), min(speech_hi, nbins))
+        # Total and speech-band energies of a spectrum in one BLAS matmul
+        self._energy_weights = np.zeros((nbins, 2), dtype=np.float32)
+        self._energy_weights[:, 0] = 1.0
+        self._energy_weights[speech_band, 1] = 1.0
+        # By Parseval a frame's rfft power is at most frame_size * sum(x^2) (the
+        # Hann window only lowers it), so a buffer below this sample energy is
+        # silent in every frame and can skip the spectral work entirely
+        self._silence_energy = 1e-10 / frame_size
+        # Small frames (e.g. 160-sample telephony): one matmul against a real
+        # DFT matrix [cos | sin] is faster than a generic FFT call. The Hann
+        # window is folded into its rows, so frames skip the window multiply.
+        if frame_size <= 256:
+            angle = 2 * np.pi * np.outer(np.arange(frame_size), np.arange(nbins)) / frame_size
+            dft = np.hstack([np.cos(angle), np.sin(angle)])
+            self._dft_matrix = (self._window[:, None] * dft).astype(np.float32)
+        else:
+            self._dft_matrix = None
+            self._rfft = _get_rfft()
+        # Reusable decode and spectrum buffers, grown for multi-frame buffers
+        self._alloc_buffers(1)
+        # Previous spectrum, updated in place every frame (silence before the first)
+        self.prev_spectrum = np.zeros(nbins, dtype=np.float32)
+    
+    @property
+    def noise_history(self) -> np.ndarray:
+        """Recent non-zero scores, oldest first"""
+        if self._noise_fill < len(self._noise_ring):
+            return self._noise_ring[:self._noise_fill].copy()
+        return np.roll(self._noise_ring, -self._noise_head)
+    
+    def _alloc_buffers(self, n_frames: int):
+        """Allocate reusable per-call buffers for up to n_frames frames"""
+        nbins = self.frame_size // 2 + 1
+        # Slot 0 of the decode buffer holds the sample before the decoded ones
+        self._decode_buf = np.empty(n_frames * self.frame_size + 1, dtype=np.float32)
+        self._frame_buf = np.empty((n_frames, self.frame_size), dtype=np.float32)
+        self._sign_buf = np.empty((n_frames, self.frame_size), dtype=bool)
+        self._cross_buf = np.empty((n_frames, max(self.frame_size - 1, 0)), dtype=bool)
+        self._dft_buf = np.empty((n_frames, 2 * nbins), dtype=np.float32)
+        self._spectrum_buf = np.empty((n_frames, nbins), dtype=np.float32)
+        self._energy_buf = np.empty((n_frames, 2), dtype=np.float32)
+        self._score_buf = np.empty(n_frames, dtype=np.float64)
+        self._spec_scratch = np.empty((n_frames, nbins), dtype=np.float32)
     
     def _decode_audio(self, buffer: bytes) -> np.ndarray:
-        """Decode audio buffer to float samples"""
+        """Decode all whole frames in audio buffer to float samples (reused buffer)"""
         if self.encoding == 'mulaw':
-            return self._mulaw_table[np.frombuffer(buffer, dtype=np.uint8)]
+            codes = np.frombuffer(buffer, dtype=np.uint8)
         elif self.encoding == 'pcm16':
-            samples = np.frombuffer(buffer, dtype=np.int16)
-            return samples.astype(np.float32) / 32768.0
+            codes = np.frombuffer(buffer, dtype=np.int16)
         else:
             raise ValueError(f"Unsupported encoding: {self.encoding}")
+        
+        n_frames = len(codes) // self.frame_size
+        if n_frames > len(self._spectrum_buf):
+            self._alloc_buffers(n_frames)
+        codes = codes[:n_frames * self.frame_size]
+        samples = self._decode_buf[1:len(codes) + 1]
+        
+        if self.encoding == 'mulaw':
+            np.take(self._mulaw_table, codes, out=samples, mode='clip')
+        else:
+            np.multiply(codes, np.float32(1 / 32768.0), out=samples)
+        return samples
     
-    def _preprocess_frame(self, frame: np.ndarray) -> np.ndarray:
-        """Apply pre-emphasis and windowing"""
-        # Pre-emphasis filter: y[n] = x[n] - 0.95 * x[n-1]
-        if len(frame) > 0:
-            frame[0] -= 0.95 * self.last_sample
-            for i in range(1, len(frame)):
-                frame[i] -= 0.95 * frame[i-1]
-            self.last_sample = frame[-1]
-        
-        # Hann window
-        if len(frame) > 0:
-            window = 0.5 * (1 - np.cos(2 * np.pi * np.arange(len(frame)) / (len(frame) - 1)))
-            frame *= window
-        
-        return frame
+    def _preprocess_frames(self, samples: np.ndarray) -> np.ndarray:
+        """Apply pre-emphasis and windowing, returning (n_frames, frame_size)"""
+        # Pre-emphasis filter: y[n] = x[n] - 0.95 * x[n-1], continuous across frames.
+        # samples starts at slot 1 of the decode buffer, so x[n-1] is the same
+        # buffer shifted by one with the previous call's last sample in slot 0.
+        previous = self._decode_buf[:len(samples)]
+        previous[0] = self.last_sample
+        self.last_sample = float(samples[-1])
+        frames = self._frame_buf[:len(samples) // self.frame_size]
+        flat = frames.reshape(-1)
+        np.multiply(previous, -0.95, out=flat)
+        flat += samples
+        
+        # Hann window (already folded into the DFT matrix for small frames)
+        if self._dft_matrix is None:
+            frames *= self._window
+        
+        return frames
     
-    def _extract_features(self, frame: np.ndarray) -> float:
-        """Extract speech activity score from audio frame"""
-        if len(frame) < 16:  # Too short
-            return 0.0
+    def _extract_features(self, frames: np.ndarray) -> np.ndarray:
+        """Extract speech activity score for each audio frame (reused buffer)"""
+        n_frames = len(frames)
+        scores = self._score_buf[:n_frames]
+        scores.fill(0.0)
+        if self.frame_size < 16:  # Too short
+            return scores
         
-        # Compute power spectrum
-        spectrum = np.abs(rfft(frame)) ** 2
-        total_energy = np.sum(spectrum)
+        # Silence (e.g. TTS playback with a muted line): one dot product, no FFT
+        samples = frames.reshape(-1)
+        if np.dot(samples, samples) < self._silence_energy:
+            return scores
         
-        if total_energy < 1e-10:  # Silence
-            return 0.0
+        # Feature 3: Zero crossing rate (read before the FFT may overwrite frames;
+        # the window is non-negative, so sign bits are the same with or without it)
+        signs = np.signbit(frames, out=self._sign_buf[:n_frames])
+        crossings = np.not_equal(signs[:, 1:], signs[:, :-1], out=self._cross_buf[:n_frames])
+        zero_crossings = np.count_nonzero(crossings, axis=1)
+        zcr = zero_crossings / self.frame_size
+        
+        # Compute power spectra as re^2 + im^2 (skips the sqrt in np.abs)
+        if self._dft_matrix is not None:
+            coeffs = np.matmul(frames, self._dft_matrix, out=self._dft_buf[:n_frames])
+            nbins = self._dft_matrix.shape[1] // 2
+            real, imag = coeffs[:, :nbins], coeffs[:, nbins:]
+        else:
+            coeffs = self._rfft(frames, axis=1, overwrite_x=True, workers=1)
+            real, imag = coeffs.real, coeffs.imag
+        spectrum = np.multiply(real, real, out=self._spectrum_buf[:n_frames])
+        spectrum += np.multiply(imag, imag, out=self._spec_scratch[:n_frames])
+        energies = np.matmul(spectrum, self._energy_weights, out=self._energy_buf[:n_frames])
+        
+        # Silent frames score zero and leave prev_spectrum untouched
+        active = energies[:, 0] >= 1e-10
+        n_active = np.count_nonzero(active)
+        if n_active == 0:
+            return scores
+        if n_active < n_frames:
+            spectrum = spectrum[active]
+            energies = energies[active]
+            zcr = zcr[active]
         
         # Feature 1: Speech band energy ratio (300-3400 Hz)
-        freqs = np.fft.rfftfreq(len(frame), 1/self.sample_rate)
-        speech_mask = (freqs >= 300) & (freqs <= 3400)
-        speech_energy = np.sum(spectrum[speech_mask])
-        energy_ratio = speech_energy / total_energy
-        
-        # Feature 2: Spectral flux (onset detection)
-        flux = 0.0
-        if self.prev_spectrum is not None:
-            diff = spectrum - self.prev_spectrum
-            flux = np.sum(diff[diff > 0])
-        self.prev_spectrum = spectrum
-        flux_norm = flux / (flux + 1.0)
+        energy_ratio = energies[:, 1] / energies[:, 0]
         
-        # Feature 3: Zero crossing rate
-        zero_crossings = np.sum(np.diff(np.sign(frame)) != 0)
-        zcr = zero_crossings / len(frame)
+        # Feature 2: Spectral flux (onset detection), each frame vs the one before
+        diff = self._spec_scratch[:n_active]
+        np.subtract(spectrum[0], self.prev_spectrum, out=diff[0])
+        np.subtract(spectrum[1:], spectrum[:-1], out=diff[1:])
+        flux = np.maximum(diff, 0.0, out=diff).sum(axis=1)
+        np.copyto(self.prev_spectrum, spectrum[-1])
+        flux_norm = flux / (flux + 1.0)
         
         # Combine features
-        score = 0.6 * energy_ratio + 0.3 * flux_norm + 0.1 * min(1.0, zcr * 10)
+        scores[active] = 0.6 * energy_ratio + 0.3 * flux_norm + 0.1 * np.minimum(1.0, zcr * 10)
         
-        return score
+        return scores
+    
+    def _run_state_machine(self, scores: np.ndarray) -> bool:
+        """Advance noise floor and state machine over frame scores in order"""
+        # Work on locals and write state back once per buffer
+        ring, ranked = self._noise_ring, self._noise_sorted
+        head, fill = self._noise_head, self._noise_fill
+        is_speaking, consecutive = self.is_speaking, self.consecutive_speech
+        enter_threshold, exit_threshold = self.enter_threshold, self.exit_threshold
+        onset = False
+        
+        for score in scores.tolist():
+            # Update noise floor (only with non-zero scores)
+            if score > 0:
+                if fill == len(ring):
+                    del ranked[bisect_left(ranked, ring[head])]
+                else:
+                    fill += 1
+                ring[head] = score
+                head = (head + 1) % len(ring)
+                insort(ranked, score)
+            
+            # Need some history before we can detect
+            if fill < 10:
+                continue
+            
+            # Calculate adaptive threshold (ranked holds the fill scores, sorted)
+            mid = fill // 2
+            if fill & 1:
+                noise_floor = ranked[mid]
+            else:
+                noise_floor = 0.5 * (ranked[mid - 1] + ranked[mid])
+            
+            # State machine logic
+            if not is_speaking:
+                # Check for speech start
+                if score > noise_floor + enter_threshold:
+                    consecutive += 1
+                    if consecutive >= self.onset_frames:
+                        is_speaking = True
+                        onset = True  # Speech onset detected!
+                else:
+                    consecutive = 0
+            elif score < noise_floor + exit_threshold:
+                # Speech ended
+                is_speaking = False
+                consecutive = 0
+        
+        self._noise_head, self._noise_fill = head, fill
+        self.is_speaking, self.consecutive_speech = is_speaking, consecutive
+        return onset
     
     def process_audio(self, audio_buffer: bytes) -> bool:
         """
         Process audio buffer and detect speech onset.
         
+        Buffers holding several frames (e.g. 40ms chunks) are processed
+        frame by frame; trailing samples short of a full frame are dropped.
+        
         Args:
             audio_buffer: Raw audio data (mu-law bytes or PCM16)
             
         Returns:
-            bool: True if speech onset detected, False otherwise
+            bool: True if speech onset detected in any frame, False otherwise
         """
         # Decode audio
         samples = self._decode_audio(audio_buffer)
         
         # Only process if we have enough samples for a frame
-        if len(samples) < self.frame_size:
+        if len(samples) == 0:
             return False
         
-        # Take first frame (ignore extra samples)
-        frame = samples[:self.frame_size]
-        
-        # Preprocess
-        frame = self._preprocess_frame(frame.copy())
-        
-        # Extract features
-        score = self._extract_features(frame)
-        
-        # Update noise floor (only with non-zero scores)
-        if score > 0:
-            self.noise_history.append(score)
+        # Preprocess: pre-emphasis into the reused frame buffer (slot 0 of the
+        # decode buffer is overwritten with the carried-over last sample)
+        frames = self._preprocess_frames(samples)
         
-        # Need some history before we can detect
-        if len(self.noise_history) < 10:
-            return False
-        
-        # Calculate adaptive threshold
-        noise_floor = np.median(self.noise_history)
-        
-        # State machine logic
-        if not self.is_speaking:
-            # Check for speech start
-            if score > noise_floor + self.enter_threshold:
-                self.consecutive_speech += 1
-                if self.consecutive_speech >= self.onset_frames:
-                    self.is_speaking = True
-                    return True  # Speech onset detected!
-            else:
-                self.consecutive_speech = 0
-        else:
-            # Check for speech end
-            if score < noise_floor + self.exit_threshold:
-                self.is_speaking = False
-                self.consecutive_speech = 0
+        # Extract features for all frames at once
+        scores = self._extract_features(frames)
         
-        return False
+        # Run the state machine over the frames in order
+        return self._run_state_machine(scores)
     
     def reset(self):
         """Reset detector state"""
         self.is_speaking = False
         self.consecutive_speech = 0
-        self.noise_history.clear()
-        self.prev_spectrum = None
+        self._noise_head = 0
+        self._noise_fill = 0
+        self._noise_sorted.clear()
+        self.prev_spectrum.fill(0.0)
         self.last_sample = 0.0
 
 